@@ -0,0 +1,131 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fitz
+import instrument
+from extract_pdf_data import extract_geometric_features
+from feature_export import export_jsonl
+
+MANIFEST_NAME = "manifest.json"
+
+def find_pdfs(inputs):
+    pdf_paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.pdf")
+        pdf_paths.extend(path for path in glob.glob(pattern, recursive=True) if path.lower().endswith(".pdf"))
+    return sorted(set(os.path.abspath(path) for path in pdf_paths))
+
+def output_names(pdf_paths):
+    """Name each document's output after its file name, adding a path hash when names collide."""
+    names = {}
+    seen = set()
+    for pdf_path in pdf_paths:
+        name = os.path.splitext(os.path.basename(pdf_path))[0]
+        if name in seen:
+            name = f"{name}-{hashlib.sha1(pdf_path.encode('utf-8')).hexdigest()[:8]}"
+        seen.add(name)
+        names[pdf_path] = name
+    return names
+
+def source_signature(pdf_path):
+    stat = os.stat(pdf_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def is_done(entry, pdf_path, output_dir, binary=False):
+    return (entry is not None and entry.get("source") == source_signature(pdf_path)
+            and os.path.exists(os.path.join(output_dir, entry["output"]))
+            and (entry.get("binary", False) or not binary))
+
+def extract_document(pdf_path, output_path, binary=False, profile=False):
+    """Extract one document in a worker process. With profile=True the worker's stage
+    timings are returned under "stages" for the parent to merge into its summary."""
+    if profile:
+        instrument.enable(report=False)
+        stages_before = instrument.snapshot()
+    start = time.perf_counter()
+    with fitz.open(pdf_path) as doc:
+        pages = doc.page_count
+    if os.path.exists(output_path + ".pages.json"):
+        extract_geometric_features(pdf_path, output_path, incremental=True, verbose=False)
+    else:
+        extract_geometric_features(pdf_path, output_path, resume=True, verbose=False)
+    if binary:
+        export_jsonl(output_path)
+    with open(output_path, "rb") as f:
+        blocks = sum(1 for _ in f)
+    result = {"pages": pages, "blocks": blocks, "seconds": round(time.perf_counter() - start, 3)}
+    if profile:
+        result["stages"] = instrument.since(stages_before)
+    return result
+
+def extract_corpus(inputs, output_dir, workers=None, binary=False):
+    """Extract every PDF matched by inputs (directories or glob patterns) into output_dir,
+    one document per worker process. Documents listed as done in the manifest are skipped,
+    partially written ones resume after their last completed page, and documents whose
+    PDF changed since their last extraction only recompute the changed pages. With binary=True
+    each document is also exported as memory-mappable feature arrays."""
+    os.makedirs(output_dir, exist_ok=True)
+    pdf_paths = find_pdfs(inputs)
+    names = output_names(pdf_paths)
+    manifest = load_manifest(output_dir)
+    pending = [pdf_path for pdf_path in pdf_paths if not is_done(manifest.get(names[pdf_path]), pdf_path, output_dir, binary)]
+    print(f"{len(pdf_paths)} documents found, {len(pdf_paths) - len(pending)} already done, {len(pending)} to extract")
+    start = time.perf_counter()
+    total_pages = 0
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_document, pdf_path, os.path.join(output_dir, names[pdf_path] + ".jsonl"), binary, instrument.enabled): pdf_path for pdf_path in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            pdf_path = futures[future]
+            name = names[pdf_path]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"[{done}/{len(pending)}] {name}: failed: {e}")
+                continue
+            if "stages" in result:
+                instrument.merge(result.pop("stages"))
+            manifest[name] = {"pdf": pdf_path, "output": name + ".jsonl", "source": source_signature(pdf_path), "binary": binary, **result}
+            save_manifest(output_dir, manifest)
+            total_pages += result["pages"]
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(pending)}] {name}: {result['pages']} pages in {result['seconds']:.1f}s, {total_pages / elapsed:.1f} pages/s overall")
+    elapsed = time.perf_counter() - start
+    print(f"Extracted {total_pages} pages from {len(pending) - failures} documents in {elapsed:.1f}s ({total_pages / elapsed if elapsed else 0:.1f} pages/s), {failures} failed")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract block features from a corpus of PDFs.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default="extracted", help="directory for per-document outputs and the manifest")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--binary", action="store_true", help="also export .features.npy matrices for training (see feature_export.py)")
+    parser.add_argument("--profile", action="store_true", help="print stage timings, summed over all worker processes, at exit")
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable()
+    failures = extract_corpus(args.inputs, args.output_dir, args.workers, args.binary)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
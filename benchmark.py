@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import fitz
+from PIL import Image
+import extract_pdf_data
+from utils import render_page, extract_blocks
+from block_table import BlockTable
+from extract_pdf_data import extract_geometric_features
+
+SYNTHETIC_WORDS = "the of and to in a is that for it as was with be by on not he this are or his from at which but have an they you were their one all we can her has there been if more when will would who so no".split()
+
+def make_synthetic_pdf(pdf_path, pages=1, blocks_per_page=20, columns=1, font_sizes=(10,), drop_caps=False, seed=0):
+    """Write a reproducible PDF of text blocks laid out in columns. Each block gets a
+    font size drawn from font_sizes, and with drop_caps the first block of each column
+    starts with a large single-letter block, as in books with drop caps."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        margin = 36
+        rows = -(-blocks_per_page // columns)
+        column_width = (page.rect.width - 2 * margin) / columns
+        block_height = (page.rect.height - 2 * margin) / rows
+        for i in range(blocks_per_page):
+            column, row = divmod(i, rows)
+            x0, y0 = margin + column * column_width, margin + row * block_height
+            x1 = x0 + column_width - 12
+            if drop_caps and row == 0:
+                cap_size = block_height * 0.6
+                page.insert_text((x0, y0 + cap_size), "T", fontsize=cap_size)
+                x0 += cap_size
+            fontsize = min(rng.choice(font_sizes), block_height * 0.5)
+            words_per_line = max(2, int((x1 - x0) / (fontsize * 3.5)))
+            line_count = max(1, min(3, int(block_height * 0.7 // (fontsize * 1.2))))
+            lines = [" ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(words_per_line)) for _ in range(line_count)]
+            lines[0] = f"{i + 1}. {lines[0]}"
+            page.insert_text((x0, y0 + fontsize), "\n".join(lines), fontsize=fontsize)
+    doc.save(pdf_path)
+    doc.close()
+
+def bench_blocks_per_page(block_counts=(25, 50, 100, 200), pages=4):
+    print(f"{'blocks/page':>12} {'s/page':>10} {'ms/block':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        output_path = os.path.join(tmp, "output.jsonl")
+        make_synthetic_pdf(pdf_path, 1, block_counts[0])
+        extract_geometric_features(pdf_path, output_path, verbose=False) #Untimed warm-up, so the first row does not include loading wordfreq
+        for blocks_per_page in block_counts:
+            make_synthetic_pdf(pdf_path, pages, blocks_per_page)
+            start = time.perf_counter()
+            extract_geometric_features(pdf_path, output_path, verbose=False)
+            per_page = (time.perf_counter() - start) / pages
+            print(f"{blocks_per_page:>12} {per_page:>10.4f} {per_page / blocks_per_page * 1000:>10.3f}")
+
+def render_zoom_then_downscale(page, max_width, max_height, zoom=2):
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    scale = min(max_width / img.width, max_height / img.height, 1)
+    return img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.LANCZOS)
+
+def bench_render(pages=10, blocks_per_page=60, sizes=((1400, 800), (1536, 864))):
+    print(f"{'target':>12} {'zoom 2 + LANCZOS ms':>20} {'direct ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        make_synthetic_pdf(pdf_path, pages, blocks_per_page)
+        doc = fitz.open(pdf_path)
+        for max_width, max_height in sizes:
+            timings = []
+            for render in (render_zoom_then_downscale, render_page):
+                start = time.perf_counter()
+                for page in doc:
+                    render(page, max_width, max_height)
+                timings.append((time.perf_counter() - start) / pages * 1000)
+            print(f"{f'{max_width}x{max_height}':>12} {timings[0]:>20.1f} {timings[1]:>10.1f}")
+        doc.close()
+
+def synthetic_block_rows(count, pages=500):
+    for i in range(count):
+        page = i * pages // count
+        text = f"{page + 1}" if i % 20 == 0 else f"Paragraph {i} of a synthetic book, with some ordinary words in it.\n"
+        yield page, (72.0 + i % 7, 100.0 + i % 40 * 15, 540.0, 112.0 + i % 40 * 15, text, i % 40, 0)
+
+def measure_allocations(build):
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+def bench_memory(counts=(10_000, 100_000, 1_000_000)):
+    def build_dicts(count):
+        return [{'page': page, 'x0': raw[0], 'y0': raw[1], 'x1': raw[2], 'y1': raw[3], 'raw_block': raw} for page, raw in synthetic_block_rows(count)]
+    def build_table(count):
+        table = BlockTable()
+        for page, raw in synthetic_block_rows(count):
+            table.append({'page': page, 'x0': raw[0], 'y0': raw[1], 'x1': raw[2], 'y1': raw[3], 'text': raw[4]})
+        return table
+    print(f"{'blocks':>10} {'dicts MB':>10} {'table MB':>10} {'ratio':>7}")
+    for count in counts:
+        dicts, dict_bytes = measure_allocations(lambda: build_dicts(count))
+        del dicts
+        table, table_bytes = measure_allocations(lambda: build_table(count))
+        del table
+        print(f"{count:>10} {dict_bytes / 1e6:>10.1f} {table_bytes / 1e6:>10.1f} {dict_bytes / table_bytes:>7.1f}")
+
+def bench_text_statistics(repeats=20, pages=20, blocks_per_page=40):
+    """Time calculate_text_statistics on the block texts of a synthetic PDF.
+    Its agreement with the separate feature functions is tested in test_extract_pdf_data.py."""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        make_synthetic_pdf(pdf_path, pages, blocks_per_page, font_sizes=(9, 10, 12))
+        texts = extract_blocks(pdf_path).column("text")
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            extract_pdf_data.calculate_text_statistics(text)
+    print(f"{len(texts)} blocks, {(time.perf_counter() - start) / repeats / len(texts) * 1e6:.2f} µs per block")
+
+STARTUP_SNIPPET = """
+import time, resource
+start = time.perf_counter()
+import extract_pdf_data
+{extra}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def bench_startup(repeats=3):
+    variants = {
+        "lazy (default)": "",
+        "eager spaCy + wordfreq": "extract_pdf_data.get_nlp(); extract_pdf_data.word_frequency('the', 'en')",
+    }
+    print(f"{'variant':>24} {'import s':>10} {'peak MB':>10}")
+    for name, extra in variants.items():
+        runs = []
+        for _ in range(repeats):
+            result = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET.format(extra=extra)], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode != 0:
+                break
+            elapsed, max_rss = result.stdout.split()
+            runs.append((float(elapsed), int(max_rss) / 1024))
+        if not runs:
+            error = (result.stderr.strip().splitlines() or ["unknown error"])[-1]
+            print(f"{name:>24} {'unavailable':>10} ({error})")
+            continue
+        elapsed, peak = min(runs)
+        print(f"{name:>24} {elapsed:>10.3f} {peak:>10.1f}")
+
+GUI_RENDER_SIZES = {"manually_classify": (1400, 800), "draw_classify": (1536, 864)}
+
+def time_runs(function, repeats):
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+def render_all_pages(pdf_path, max_width, max_height):
+    doc = fitz.open(pdf_path)
+    for page in doc:
+        render_page(page, max_width, max_height)
+    doc.close()
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(config, repeats=3, output_file="bench_results.json"):
+    """Time extraction, block listing and GUI page rendering on a synthetic PDF and
+    append the results as one JSON line to output_file, for comparison across commits."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        output_path = os.path.join(tmp, "output.jsonl")
+        make_synthetic_pdf(pdf_path, **config)
+        stages = {
+            "extract_geometric_features": lambda: extract_geometric_features(pdf_path, output_path, verbose=False),
+            "utils.extract_blocks": lambda: extract_blocks(pdf_path),
+        }
+        for gui, (max_width, max_height) in GUI_RENDER_SIZES.items():
+            stages[f"render_page[{gui}]"] = lambda size=(max_width, max_height): render_all_pages(pdf_path, *size)
+        for name, function in stages.items():
+            runs = time_runs(function, repeats)
+            results[name] = {"runs_s": runs, "median_ms_per_page": statistics.median(runs) / config["pages"] * 1000}
+            print(f"{name:>36} {results[name]['median_ms_per_page']:>10.2f} ms/page")
+    record = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pymupdf": fitz.VersionBind,
+        "machine": platform.machine(),
+        "config": config,
+        "repeats": repeats,
+        "results": results,
+    }
+    with open(output_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Results appended to {output_file}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic PDFs.")
+    parser.add_argument("benchmark", nargs="?", default="suite", choices=["suite", "blocks", "startup", "text", "render", "memory"])
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--blocks-per-page", type=int, default=40)
+    parser.add_argument("--columns", type=int, default=2)
+    parser.add_argument("--font-sizes", default="9,10,10,10,12,18", help="comma-separated sizes to draw block font sizes from")
+    parser.add_argument("--drop-caps", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default="bench_results.json", help="JSON lines file the suite appends to")
+    args = parser.parse_args()
+    if args.benchmark == "suite":
+        config = {"pages": args.pages, "blocks_per_page": args.blocks_per_page, "columns": args.columns,
+                  "font_sizes": [float(size) for size in args.font_sizes.split(",")], "drop_caps": args.drop_caps, "seed": args.seed}
+        run_suite(config, args.repeats, args.output)
+    else:
+        {"blocks": bench_blocks_per_page, "startup": bench_startup, "text": bench_text_statistics, "render": bench_render, "memory": bench_memory}[args.benchmark]()
+
+if __name__ == "__main__":
+    main()
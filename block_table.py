@@ -0,0 +1,99 @@
+import numpy as np
+
+BLOCK_COLUMNS = [("page", np.int32), ("x0", np.float64), ("y0", np.float64), ("x1", np.float64), ("y1", np.float64), ("text", str)]
+
+class BlockTable:
+    """Columnar block storage. Numeric columns live in growable NumPy arrays and
+    str columns hold ids into one string pool, in which repeated strings are stored
+    once. Rows are read through BlockView, which behaves like the old block dicts.
+    None in a float column is stored as NaN and read back as None."""
+    def __init__(self, columns=BLOCK_COLUMNS, capacity=256):
+        self.dtypes = dict(columns)
+        self.arrays = {name: np.empty(capacity, dtype=np.int32 if dtype is str else dtype) for name, dtype in columns}
+        self.strings = []
+        self.string_ids = {}
+        self.size = 0
+        self.capacity = capacity
+
+    def intern(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    def append(self, values):
+        if self.size == self.capacity:
+            self._grow()
+        for name, dtype in self.dtypes.items():
+            value = values[name]
+            if dtype is str:
+                value = self.intern(value)
+            elif value is None:
+                value = np.nan
+            self.arrays[name][self.size] = value
+        self.size += 1
+        return self.size - 1
+
+    def extend(self, rows):
+        for values in rows:
+            self.append(values)
+
+    def _grow(self):
+        self.capacity = max(2 * self.capacity, 16)
+        for name, array in self.arrays.items():
+            grown = np.empty(self.capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def column(self, name):
+        """The filled part of a numeric column as an array view, or a str column as a list."""
+        values = self.arrays[name][:self.size]
+        if self.dtypes[name] is str:
+            return [self.strings[string_id] for string_id in values]
+        return values
+
+    def get(self, idx, name):
+        value = self.arrays[name][idx]
+        if self.dtypes[name] is str:
+            return self.strings[value]
+        value = value.item()
+        return None if value != value else value
+
+    def to_dict(self, idx):
+        return {name: self.get(idx, name) for name in self.dtypes}
+
+    def iter_dicts(self):
+        return (self.to_dict(idx) for idx in range(self.size))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("block index out of range")
+        return BlockView(self, idx)
+
+    def __iter__(self):
+        return (BlockView(self, idx) for idx in range(self.size))
+
+class BlockView:
+    __slots__ = ("table", "idx")
+
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    def __getitem__(self, name):
+        return self.table.get(self.idx, name)
+
+    def get(self, name, default=None):
+        return self.table.get(self.idx, name) if name in self.table.dtypes else default
+
+    def keys(self):
+        return self.table.dtypes.keys()
+
+    def to_dict(self):
+        return self.table.to_dict(self.idx)
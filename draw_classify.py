@@ -2,19 +2,32 @@ import os
 import fitz
 import tkinter as tk
 from tkinter import messagebox
-from PIL import Image, ImageTk
-from utils import extract_blocks, drop_to_file
+from PIL import ImageTk
+from instrument import stage
+from utils import LazyBlockList, LabelWriter, SessionJournal, LayoutSignatureIndex, render_page, BlockGrid
 
 class ManualClassifierGUI:
     def __init__(self, pdf_path):
         self.pdf_path = pdf_path
         self.doc = fitz.open(pdf_path)
         self.total_pages = self.doc.page_count
-        self.all_blocks = extract_blocks(pdf_path)
-        self.current_page = 0
-        # For each block store the classification (None if unmarked)
-        self.block_classifications = [None] * len(self.all_blocks)
+        self.all_blocks = LazyBlockList(self.doc)
+        self.page_blocks = self.all_blocks.page_blocks
+        self.page_grids = {}
+        self.block_items = {}
+        self.layout_index = LayoutSignatureIndex(self.all_blocks)
+        self.pending_propagations = []
+        # For each block store the classification (unmarked blocks are absent), resuming from the journal
+        self.journal = SessionJournal(pdf_path)
+        self.block_classifications, _, self.current_page = self.journal.replay()
         self.current_label = 'Body'
+        if self.current_page >= self.total_pages:
+            # A finished book was reopened: rewrite the output from the journal without opening a window
+            self.write_output()
+            self.journal.close()
+            self.doc.close()
+            print("All pages were already classified.")
+            return
         
         self.label_colors = {
             'Header': '#ff0000',
@@ -65,6 +78,11 @@ class ManualClassifierGUI:
         )
         self.next_button.grid(row=0, column=len(self.button_texts), padx=1)
         
+        # Bulk mode applies a label to matching blocks on all pages
+        self.bulk_mode = tk.BooleanVar(value=False)
+        self.bulk_button = tk.Checkbutton(self.control_frame, text="Bulk", variable=self.bulk_mode)
+        self.bulk_button.grid(row=0, column=len(self.button_texts) + 1, padx=1)
+        
         # Status label
         self.status_var = tk.StringVar()
         self.status_label = tk.Label(self.root, textvariable=self.status_var, bg="white")
@@ -76,12 +94,13 @@ class ManualClassifierGUI:
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # Rendering parameters
-        self.zoom = 2
         self.scale = 1.0
         self.geometry_set = False
         
         self.load_current_page()
+        self.root.after(1, self.extract_in_background)
         self.root.mainloop()
+        self.doc.close()
 
     def set_current_label(self, label):
         self.current_label = label
@@ -92,36 +111,32 @@ class ManualClassifierGUI:
             self.finish_classification()
             return
 
+        # Render directly at the display size
+        self.all_blocks.ensure_page(self.current_page)
         page = self.doc.load_page(self.current_page)
-        mat = fitz.Matrix(self.zoom, self.zoom)
-        pix = page.get_pixmap(matrix=mat)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # Calculate scaling for display
         max_width = self.root.winfo_screenwidth() * 0.8
         max_height = self.root.winfo_screenheight() * 0.8
-        img_width, img_height = img.size
-        self.scale = min(max_width / img_width, max_height / img_height, 1)
-        new_size = (int(img_width * self.scale), int(img_height * self.scale))
-        img = img.resize(new_size, Image.Resampling.LANCZOS)
+        img, self.scale = render_page(page, max_width, max_height)
+        new_size = img.size
         
         # Update canvas
-        self.photo = ImageTk.PhotoImage(img)
+        with stage("photo_image"):
+            self.photo = ImageTk.PhotoImage(img)
         self.canvas.config(width=new_size[0], height=new_size[1])
         self.canvas.delete("all")
         self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
         
         # Draw block outlines on current page in natural order
-        for idx, block in enumerate(self.all_blocks):
-            if block['page'] != self.current_page:
-                continue
-            zoomed_x0 = block['x0'] * self.zoom * self.scale
-            zoomed_y0 = block['y0'] * self.zoom * self.scale
-            zoomed_x1 = block['x1'] * self.zoom * self.scale
-            zoomed_y1 = block['y1'] * self.zoom * self.scale
+        self.block_items = {}
+        for idx in self.page_blocks[self.current_page]:
+            block = self.all_blocks[idx]
+            zoomed_x0 = block['x0'] * self.scale
+            zoomed_y0 = block['y0'] * self.scale
+            zoomed_x1 = block['x1'] * self.scale
+            zoomed_y1 = block['y1'] * self.scale
             # Use the color corresponding to the classification, or black if unmarked.
-            outline_color = self.label_colors.get(self.block_classifications[idx], 'black')
-            self.canvas.create_rectangle(
+            outline_color = self.label_colors.get(self.block_classifications.get(idx), 'black')
+            self.block_items[idx] = self.canvas.create_rectangle(
                 zoomed_x0, zoomed_y0, zoomed_x1, zoomed_y1,
                 outline=outline_color, fill="", width=2
             )
@@ -131,61 +146,118 @@ class ManualClassifierGUI:
             self.root.geometry(f"{new_size[0]}x{window_height}")
             self.geometry_set = True
 
-        self.status_var.set(f"Page {self.current_page + 1} of {self.total_pages}")
+        self.update_status()
         self.update_button_highlight()
 
+    def update_status(self):
+        total_blocks = f", {len(self.all_blocks)} blocks" if self.all_blocks.complete else ""
+        self.status_var.set(f"Page {self.current_page + 1} of {self.total_pages}{total_blocks}")
+
+    def extract_in_background(self):
+        """Extract the remaining pages one per event loop turn, so the window stays responsive."""
+        if self.all_blocks.extract_next_page():
+            self.layout_index.update()
+            self.root.after(1, self.extract_in_background)
+        elif self.current_page < self.total_pages:
+            self.update_status()
+            while self.pending_propagations:
+                self.propagate_label(*self.pending_propagations.pop(0))
+
     def on_canvas_click(self, event):
         x = self.canvas.canvasx(event.x)
         y = self.canvas.canvasy(event.y)
-        pdf_x = x / (self.zoom * self.scale)
-        pdf_y = y / (self.zoom * self.scale)
-        # Identify the clicked block on the current page
-        for idx, block in enumerate(self.all_blocks):
-            if block['page'] != self.current_page:
-                continue
-            if block['x0'] <= pdf_x <= block['x1'] and block['y0'] <= pdf_y <= block['y1']:
-                self.block_classifications[idx] = self.current_label
-                self.load_current_page()
-                break
+        pdf_x = x / self.scale
+        pdf_y = y / self.scale
+        # Identify the clicked block on the current page and recolour only its outline
+        if self.current_page not in self.page_grids:
+            self.page_grids[self.current_page] = BlockGrid(self.all_blocks, self.page_blocks[self.current_page])
+        idx = self.page_grids[self.current_page].find(pdf_x, pdf_y)
+        if idx is not None:
+            self.journal.append("label", idx, self.current_label)
+            self.block_classifications[idx] = self.current_label
+            self.canvas.itemconfig(self.block_items[idx], outline=self.label_colors[self.current_label])
+            if self.bulk_mode.get():
+                self.propagate_label(idx, self.current_label)
+
+    def propagate_label(self, idx, label):
+        """Preview and apply label to blocks matching idx by position and text on all pages.
+        The layout index is filled as pages are extracted in the background; a click before
+        that has finished is queued and runs once the last page is indexed."""
+        if not self.all_blocks.complete:
+            self.pending_propagations.append((idx, label))
+            remaining = self.total_pages - len(self.page_blocks)
+            self.status_var.set(f"Bulk label queued until the remaining {remaining} pages are indexed")
+            return
+        matches = [other for other in self.layout_index.matches(idx) if self.block_classifications.get(other) != label]
+        if not matches:
+            self.status_var.set("No other matching blocks found")
+            return
+        for other in matches:
+            if other in self.block_items:
+                self.canvas.itemconfig(self.block_items[other], dash=(4, 2))
+        pages = sorted({self.all_blocks[other]['page'] + 1 for other in matches})
+        page_list = ", ".join(map(str, pages[:10])) + (", ..." if len(pages) > 10 else "")
+        sample = self.all_blocks[matches[0]]['text'].strip()[:60]
+        apply = messagebox.askyesno("Bulk label", f"Label {len(matches)} matching blocks as {label}?\n\nPages: {page_list}\nExample: {sample}")
+        for other in matches:
+            if other in self.block_items:
+                self.canvas.itemconfig(self.block_items[other], dash=())
+        if not apply:
+            return
+        self.journal.append_many(("label", other, label) for other in matches)
+        for other in matches:
+            self.block_classifications[other] = label
+            if other in self.block_items:
+                self.canvas.itemconfig(self.block_items[other], outline=self.label_colors[label])
+        self.status_var.set(f"Labelled {len(matches)} matching blocks on {len(pages)} pages as {label}")
 
     def on_key_press(self, event):
         key = event.keysym.lower()
         if key in self.key_to_label:
             self.set_current_label(self.key_to_label[key])
+        elif key == 'm':
+            self.bulk_mode.set(not self.bulk_mode.get())
 
     def update_button_highlight(self):
         for btn in self.buttons:
             btn.config(relief=tk.SUNKEN if btn['text'] == (self.current_label if self.current_label != "Exclude" else "Excl.") else tk.RAISED)
 
-    def process_current_page(self):
-        """Sort and write out the blocks on the current page in reading order.
+    def write_page(self, writer, page_number):
+        """Sort and write out the blocks on a page in reading order.
            Unmarked blocks are treated as 'Exclude' and omitted from output."""
-        page_blocks = [(idx, block) for idx, block in enumerate(self.all_blocks)
-                       if block['page'] == self.current_page]
+        page_blocks = [(idx, self.all_blocks[idx]) for idx in self.page_blocks[page_number]]
         page_blocks.sort(key=lambda tup: (tup[1]['y0'], tup[1]['x0']))
         for idx, block in page_blocks:
             # Treat unmarked blocks as 'Exclude'
-            classification = self.block_classifications[idx] or 'Exclude'
+            classification = self.block_classifications.get(idx) or 'Exclude'
             # Only output blocks that are not excluded.
             if classification != 'Exclude':
-                drop_to_file(block['raw_block'][4], classification, block['page'])
+                writer.write(block['text'], classification.lower(), block['page'])
+
+    def write_output(self):
+        """Compact the journalled labels of all finished pages into the output files."""
+        with LabelWriter() as writer:
+            for page_number in range(min(self.current_page, self.total_pages)):
+                self.all_blocks.ensure_page(page_number)
+                self.write_page(writer, page_number)
     
     def next_page(self):
-        self.process_current_page()
         self.current_page += 1
+        self.journal.append("page", self.current_page)
         if self.current_page >= self.total_pages:
             self.finish_classification()
         else:
             self.load_current_page()
 
     def finish_classification(self):
-        if self.current_page < self.total_pages:
-            self.process_current_page()
+        self.write_output()
+        self.journal.close()
         messagebox.showinfo("Complete", "Classification saved successfully!")
-        self.doc.close()
-        self.root.quit()
+        self.root.destroy()
 
     def on_close(self):
+        self.write_output()
+        self.journal.close()
         self.root.destroy()
 
 def main():
@@ -194,10 +266,8 @@ def main():
     if not os.path.exists(pdf_path):
         print(f"Error: File {pdf_path} not found!")
         return
-    # Clear the output file
-    open("output.txt", "w", encoding='utf-8').close()
     ManualClassifierGUI(pdf_path)
-    print("Classification saved to output.txt")
+    print("Classification saved to output.json")
 
 if __name__ == "__main__":
     main()
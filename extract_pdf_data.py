@@ -1,57 +1,375 @@
 import os
+import re
 import json
 import string
+import hashlib
+import textwrap
 from math import log2
 import fitz
-import spacy
 import numpy as np
-from wordfreq import word_frequency
-from collections import Counter
+from collections import Counter, deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from utils import delete_if_exists
-nlp = spacy.load("en_core_web_sm") #python -m spacy download en_core_web_sm
+from feature_cache import FeatureCache, file_hash
+import instrument
+from instrument import stage, timed
+_nlp = None
+_word_frequency = None
 
-def extract_geometric_features(pdf_path, output_json="output.json"):
-    delete_if_exists(output_json)
+FEATURE_VERSION = 2 #Increase when a feature calculation changes, to invalidate cached pages
+FEATURE_COLUMNS = [
+    ("x0", np.float64), ("y0", np.float64), ("x1", np.float64), ("y1", np.float64),
+    ("height", np.float64), ("width", np.float64), ("position", np.float64),
+    ("letter_count", np.int32), ("font_size", np.float64), ("relative_font_size", np.float64),
+    ("num_lines", np.int32), ("punctuation_proportion", np.float64),
+    ("average_words_per_sentence", np.float64), ("starts_with_number", np.int8),
+    ("capitalization_proportion", np.float64), ("average_word_commonality", np.float64),
+    ("squared_entropy", np.float64), ("page", np.int32), ("text", str), ("type", str),
+]
+PARALLEL_MIN_PAGES = 32
+PAGES_PER_TASK = 16
+WORD_CACHE_SIZE = 1 << 16
+PUNCTUATION = frozenset(string.punctuation)
+OBJECT_REFERENCE = re.compile(r"(\d+) 0 R\b")
+BACK_REFERENCE = re.compile(r"/(?:Parent|P)\s+\d+ 0 R\b")
+
+def extract_geometric_features(pdf_path, output_json="output.jsonl", workers=1, pretty=False, resume=False, cache=None, verbose=True, incremental=False):
+    """Write the features of every text block. By default one JSON line is streamed
+    per block as each page finishes and resume=True continues an interrupted run;
+    pretty=True writes the whole document as one indented JSON array instead.
+    Pass a FeatureCache to reuse pages of a PDF that was extracted before, or
+    incremental=True to recompute only the pages that changed since output_json was written.
+    Returns a Counter of word frequency cache hits and misses, which in incremental mode
+    also holds the numbers of reused and recomputed pages."""
+    if incremental and pretty:
+        raise ValueError("incremental extraction needs the JSON lines format, not pretty=True")
+    if incremental:
+        return update_geometric_features(pdf_path, output_json, workers, verbose)
+    word_cache_stats = Counter()
+    if pretty:
+        delete_if_exists(output_json)
+        pages = iter_page_features(pdf_path, workers, word_cache_stats, cache=cache)
+        save_to_json((block for page_data in pages for block in page_data), output_json)
+    else:
+        if not resume:
+            delete_if_exists(output_json + ".pages.json")
+        with JsonlFeatureWriter(output_json, resume) as writer:
+            if writer.next_page and verbose:
+                print(f"Resuming from page {writer.next_page + 1}")
+            pages = iter_page_features(pdf_path, workers, word_cache_stats, writer.next_page, cache)
+            for page_num, page_data in enumerate(pages, writer.next_page):
+                writer.write_page(page_num, page_data)
+        save_fingerprints(output_json, page_fingerprints(pdf_path))
+    if verbose:
+        print(f"Word frequency cache: {word_cache_stats['hits']} hits, {word_cache_stats['misses']} misses")
+        print("Done")
+    return word_cache_stats
+
+def update_geometric_features(pdf_path, output_json="output.jsonl", workers=1, verbose=True):
+    """Bring an existing JSON lines output up to date with an edited or extended PDF.
+    Pages are matched to the previous run by content fingerprint, so unchanged pages
+    keep their blocks (renumbered if they moved) and only new or changed pages are
+    computed, drop caps included. Returns the word frequency cache counts, as
+    extract_geometric_features does, with the numbers of reused and recomputed pages added."""
+    fingerprints = page_fingerprints(pdf_path)
+    old_fingerprints = load_fingerprints(output_json)
+    if old_fingerprints is None or not os.path.exists(output_json):
+        if verbose:
+            print("No fingerprints from a previous run of this feature version, extracting every page")
+        word_cache_stats = extract_geometric_features(pdf_path, output_json, workers, verbose=verbose)
+        word_cache_stats.update(reused=0, recomputed=len(fingerprints))
+        return word_cache_stats
+    old_pages = {}
+    for page_num, fingerprint in enumerate(old_fingerprints):
+        old_pages.setdefault(fingerprint, page_num)
+    old_blocks = {}
+    with open(output_json, encoding="utf-8") as f:
+        for line in f:
+            block = json.loads(line)
+            old_blocks.setdefault(block["page"], []).append(block)
+    changed_pages = [page_num for page_num, fingerprint in enumerate(fingerprints) if fingerprint not in old_pages]
+    word_cache_stats = Counter()
+    computed = compute_pages(pdf_path, changed_pages, workers, word_cache_stats)
+    updated_json = output_json + ".updating"
+    with JsonlFeatureWriter(updated_json) as writer:
+        for page_num, fingerprint in enumerate(fingerprints):
+            if fingerprint in old_pages:
+                page_data = old_blocks.get(old_pages[fingerprint], [])
+                for block in page_data:
+                    block["page"] = page_num
+            else:
+                page_data = next(computed)
+            writer.write_page(page_num, page_data)
+    os.replace(updated_json, output_json)
+    os.replace(updated_json + ".progress", output_json + ".progress")
+    save_fingerprints(output_json, fingerprints)
+    word_cache_stats.update(reused=len(fingerprints) - len(changed_pages), recomputed=len(changed_pages))
+    if verbose:
+        print(f"{word_cache_stats['reused']} pages reused, {word_cache_stats['recomputed']} recomputed")
+    return word_cache_stats
+
+def page_fingerprints(pdf_path):
+    """Hash each page's size and rotation together with every object its content and
+    resources reach (content streams, form XObjects, fonts and images, streams included),
+    so an edit inside a form XObject changes the fingerprint of each page that shows it."""
+    doc = fitz.open(pdf_path)
+    try:
+        object_digests = {}
+        fingerprints = []
+        for page in doc:
+            digest = hashlib.sha256(f"{tuple(page.rect)}|{page.rotation}".encode("utf-8"))
+            for key in ("Contents", "Resources"):
+                value = inherited_page_key(doc, page.xref, key)
+                digest.update(f"/{key} {value}".encode("utf-8"))
+                for xref in reachable_objects(doc, value):
+                    if xref not in object_digests:
+                        object_digest = hashlib.sha256(doc.xref_object(xref, compressed=True).encode("utf-8"))
+                        if doc.xref_is_stream(xref):
+                            object_digest.update(doc.xref_stream_raw(xref) or b"")
+                        object_digests[xref] = object_digest.digest()
+                    digest.update(object_digests[xref])
+            fingerprints.append(digest.hexdigest())
+        return fingerprints
+    finally:
+        doc.close()
+
+def inherited_page_key(doc, xref, key):
+    """The value of a page dictionary key, looked up through the page tree if the page inherits it."""
+    while xref:
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != "null":
+            return value
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if kind == "xref" else 0
+    return ""
+
+def reachable_objects(doc, value):
+    """The xrefs referenced by a PDF object's source, recursively, in first-visit order.
+    /Parent and /P back-references are not followed, so other pages are never reached."""
+    order = []
+    seen = set()
+    pending = deque(int(ref) for ref in OBJECT_REFERENCE.findall(value))
+    while pending:
+        xref = pending.popleft()
+        if xref in seen or not 0 < xref < doc.xref_length():
+            continue
+        seen.add(xref)
+        order.append(xref)
+        source = BACK_REFERENCE.sub("", doc.xref_object(xref, compressed=True))
+        pending.extend(int(ref) for ref in OBJECT_REFERENCE.findall(source))
+    return order
+
+def load_fingerprints(output_json):
+    """The page fingerprints of the previous run, or None if there are none or they were
+    written with a different FEATURE_VERSION, whose blocks must not be reused."""
+    fingerprints_file = output_json + ".pages.json"
+    if not os.path.exists(fingerprints_file):
+        return None
+    with open(fingerprints_file, encoding="utf-8") as f:
+        saved = json.load(f)
+    if not isinstance(saved, dict) or saved.get("version") != FEATURE_VERSION:
+        return None
+    return saved["pages"]
+
+def save_fingerprints(output_json, fingerprints):
+    with open(output_json + ".pages.json", "w", encoding="utf-8") as f:
+        json.dump({"version": FEATURE_VERSION, "pages": fingerprints}, f)
+
+def iter_page_features(pdf_path, workers=1, word_cache_stats=None, start_page=0, cache=None):
+    """Yield the processed block list of every page from start_page on, in page order.
+    Pages found in the feature cache are loaded from it and only the others are
+    computed and then stored. With workers > 1 (None for all cores) those pages are
+    split across processes, unless there are fewer than PARALLEL_MIN_PAGES of them.
+    Word frequency cache hits and misses of all workers are added to word_cache_stats."""
+    doc = fitz.open(pdf_path)
+    page_count = len(doc)
+    doc.close()
+    cached_pages = set()
+    if cache is not None:
+        doc_hash = file_hash(pdf_path)
+        cached_pages = cache.cached_pages(doc_hash, FEATURE_VERSION)
+    missing_pages = [page_num for page_num in range(start_page, page_count) if page_num not in cached_pages]
+    computed = compute_pages(pdf_path, missing_pages, workers, word_cache_stats)
+    for page_num in range(start_page, page_count):
+        if page_num in cached_pages:
+            with stage("feature_cache"):
+                page_data = cache.get(doc_hash, FEATURE_VERSION, page_num)
+            yield page_data
+            continue
+        page_data = next(computed)
+        if cache is not None:
+            with stage("feature_cache"):
+                cache.put(doc_hash, FEATURE_VERSION, page_num, page_data)
+        yield page_data
+
+def compute_pages(pdf_path, page_nums, workers=1, word_cache_stats=None):
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(page_nums) < PARALLEL_MIN_PAGES:
+        chunks = (extract_page_range(pdf_path, start, stop) for start, stop in page_ranges(page_nums, PAGES_PER_TASK))
+        yield from _merge_chunks(chunks, word_cache_stats)
+        return
+    chunk_size = max(1, min(PAGES_PER_TASK, -(-len(page_nums) // workers)))
+    starts, stops = zip(*page_ranges(page_nums, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(extract_page_range, [pdf_path] * len(starts), starts, stops, [instrument.enabled] * len(starts))
+        yield from _merge_chunks(chunks, word_cache_stats)
+
+def page_ranges(page_nums, chunk_size):
+    """Split sorted page numbers into contiguous (start, stop) runs of at most chunk_size pages."""
+    ranges = []
+    for page_num in page_nums:
+        if ranges and ranges[-1][1] == page_num and ranges[-1][1] - ranges[-1][0] < chunk_size:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([page_num, page_num + 1])
+    return [tuple(page_range) for page_range in ranges]
+
+def _merge_chunks(chunks, word_cache_stats):
+    for pages, chunk_stats, stages in chunks:
+        if word_cache_stats is not None:
+            word_cache_stats.update(chunk_stats)
+        if stages is not None:
+            instrument.merge(stages)
+        yield from pages
+
+def extract_page_range(pdf_path, start, stop, report_stages=False):
+    """Extract a run of pages. With report_stages=True, as in worker processes of a profiled
+    run, the stage timings collected here are returned so the parent can add them to its own."""
+    if report_stages:
+        instrument.enable(report=False)
+        stages_before = instrument.snapshot()
+    before = cached_word_frequency.cache_info()
     doc = fitz.open(pdf_path)
-    all_blocks = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        blocks = page.get_text("blocks")
-        all_relative_font_sizes = calculate_all_relative_font_sizes(page)
-        page_data = []
-        for idx, block in enumerate(blocks):
-            if len(block) < 6:
-                print(f"Warning: Block at index {idx} on page {page_num + 1} is incomplete")
-                continue
-            x0, y0, x1, y1, text, block_id = block[:6]
-            if text.strip():
-                page_data.append({
-                    "x0": x0, "y0": y0, "x1": x1, "y1": y1,
-                    "height": calculate_height(y0, y1),
-                    "width": calculate_width(x0, x1),
-                    "position": calculate_position(y0, page.rect.height),
-                    "letter_count": calculate_letter_count(text),
-                    "font_size": calculate_average_font_size(page, idx),
-                    "relative_font_size": all_relative_font_sizes[idx],
-                    "num_lines": calculate_num_lines(page, idx),
-                    "punctuation_proportion": calculate_punctuation_proportion(text),
-                    "average_words_per_sentence": calculate_average_words_per_sentence(text),
-                    "starts_with_number": calculate_starts_with_number(text),
-                    "capitalization_proportion": calculate_capitalization_proportion(text),
-                    "average_word_commonality": get_word_commonality(text),
-                    "squared_entropy": calculate_entropy(text) ** 2,
-                    "page": page_num,
-                    "text": text.strip(),
-                    "type": '0'
-                })
-        processed_page_data = process_drop_cap(page_data)
-        all_blocks.extend(processed_page_data)
-    save_to_json(all_blocks, output_json
-    print("Done")
+    try:
+        pages = [extract_page_features(doc.load_page(page_num), page_num) for page_num in range(start, stop)]
+    finally:
+        doc.close()
+    after = cached_word_frequency.cache_info()
+    stages = instrument.since(stages_before) if report_stages else None
+    return pages, Counter(hits=after.hits - before.hits, misses=after.misses - before.misses), stages
 
+@timed("page_features")
+def extract_page_features(page, page_num):
+    layout = PageLayout(page)
+    all_relative_font_sizes = calculate_all_relative_font_sizes(layout)
+    page_data = []
+    for idx, block in enumerate(layout.blocks):
+        if len(block) < 6:
+            print(f"Warning: Block at index {idx} on page {page_num + 1} is incomplete")
+            continue
+        x0, y0, x1, y1, text, block_id = block[:6]
+        if text.strip():
+            letter_count, punctuation_proportion, capitalization_proportion, entropy = calculate_text_statistics(text)
+            page_data.append({
+                "x0": x0, "y0": y0, "x1": x1, "y1": y1,
+                "height": calculate_height(y0, y1),
+                "width": calculate_width(x0, x1),
+                "position": calculate_position(y0, layout.height),
+                "letter_count": letter_count,
+                "font_size": calculate_average_font_size(layout, idx),
+                "relative_font_size": all_relative_font_sizes[idx],
+                "num_lines": calculate_num_lines(layout, idx),
+                "punctuation_proportion": punctuation_proportion,
+                "average_words_per_sentence": calculate_average_words_per_sentence(text),
+                "starts_with_number": calculate_starts_with_number(text),
+                "capitalization_proportion": capitalization_proportion,
+                "average_word_commonality": get_word_commonality(text),
+                "squared_entropy": entropy ** 2,
+                "page": page_num,
+                "text": text.strip(),
+                "type": '0'
+            })
+    return process_drop_cap(page_data)
+
+class PageLayout:
+    """Text layout of one page, extracted once and shared by the feature functions.
+    The "dict" blocks are matched to the "blocks" tuples by block number."""
+    def __init__(self, page):
+        self.height = page.rect.height
+        with stage("get_text"):
+            self.blocks = page.get_text("blocks")
+            layout_blocks = {block.get("number"): block for block in page.get_text("dict").get("blocks", [])}
+        self.font_sizes = []
+        self.line_counts = []
+        for block in self.blocks:
+            layout_block = layout_blocks.get(block[5], {}) if len(block) >= 6 else {}
+            lines = layout_block.get("lines", [])
+            font_sizes = [span["size"] for line in lines for span in line.get("spans", []) if "size" in span]
+            self.font_sizes.append(sum(font_sizes) / len(font_sizes) if font_sizes else None)
+            self.line_counts.append(len(lines))
+        known_sizes = [size for size in self.font_sizes if size is not None]
+        max_font_size = max(known_sizes) if known_sizes else 1
+        self.relative_font_sizes = [size / max_font_size if size is not None else None for size in self.font_sizes]
+
+class JsonlFeatureWriter:
+    """Streams one compact JSON line per block. After each page the file is flushed
+    and the byte offset of the last completed page is stored next to it, so a
+    resumed run truncates any partial page and continues with the next one."""
+    def __init__(self, output_file, resume=False):
+        self.output_file = output_file
+        self.progress_file = output_file + ".progress"
+        self.next_page = 0
+        offset = 0
+        if resume and os.path.exists(output_file) and os.path.exists(self.progress_file):
+            with open(self.progress_file, encoding="utf-8") as f:
+                progress = json.load(f)
+            self.next_page, offset = progress["next_page"], progress["offset"]
+            self.file = open(output_file, "r+b")
+        else:
+            self.file = open(output_file, "wb")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    @timed("write_output")
+    def write_page(self, page_num, page_data):
+        self.file.write("".join(json.dumps(block, ensure_ascii=False) + "\n" for block in page_data).encode("utf-8"))
+        self.file.flush()
+        self.next_page = page_num + 1
+        progress_tmp = self.progress_file + ".tmp"
+        with open(progress_tmp, "w", encoding="utf-8") as f:
+            json.dump({"next_page": self.next_page, "offset": self.file.tell()}, f)
+        os.replace(progress_tmp, self.progress_file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@timed("write_output")
 def save_to_json(data, output_file):
+    """Write the blocks as one indented JSON array, identical to json.dump(list(data), indent=2),
+    but encoding one block at a time."""
     with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+        separator = "[\n"
+        for block in data:
+            f.write(separator)
+            f.write(textwrap.indent(json.dumps(block, indent=2, ensure_ascii=False), "  "))
+            separator = ",\n"
+        f.write("[]" if separator == "[\n" else "\n]")
+
+def get_nlp():
+    """Load the spaCy model on first use; no current feature needs it."""
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load("en_core_web_sm") #python -m spacy download en_core_web_sm
+    return _nlp
+
+@timed("wordfreq_lookup")
+def word_frequency(word, lang):
+    global _word_frequency
+    if _word_frequency is None:
+        from wordfreq import word_frequency as _word_frequency
+    return _word_frequency(word, lang)
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def cached_word_frequency(word):
+    return word_frequency(word, 'en')
 
 # Utility functions
 def calculate_height(y0, y1):
@@ -71,26 +389,18 @@ def calculate_punctuation_proportion(text):
     punctuation_count = sum(1 for c in text if c in string.punctuation)
     return punctuation_count / total_characters if total_characters > 0 else 0
 
-def calculate_average_font_size(page, block_index):
-    blocks_dict = page.get_text("dict").get("blocks", [])
-    if block_index < 0 or block_index >= len(blocks_dict):
+def calculate_average_font_size(layout, block_index):
+    if block_index < 0 or block_index >= len(layout.font_sizes):
         return 0
-    block = blocks_dict[block_index]
-    font_sizes = [span["size"] for line in block.get("lines", []) for span in line.get("spans", []) if "size" in span]
-    return sum(font_sizes) / len(font_sizes) if font_sizes else None
-
-def calculate_all_relative_font_sizes(page):
-    blocks_dict = page.get_text("dict").get("blocks", [])
-    all_font_sizes = [calculate_average_font_size(page, idx) for idx in range(len(blocks_dict))]
-    all_font_sizes = [size for size in all_font_sizes if size is not None]
-    max_font_size = max(all_font_sizes) if all_font_sizes else 1
-    return [font_size / max_font_size for font_size in all_font_sizes]
-
-def calculate_num_lines(page, block_index):
-    blocks_dict = page.get_text("dict").get("blocks", [])
-    if block_index < 0 or block_index >= len(blocks_dict):
+    return layout.font_sizes[block_index]
+
+def calculate_all_relative_font_sizes(layout):
+    return layout.relative_font_sizes
+
+def calculate_num_lines(layout, block_index):
+    if block_index < 0 or block_index >= len(layout.line_counts):
         return 0
-    return len(blocks_dict[block_index].get("lines", []))
+    return layout.line_counts[block_index]
 
 def calculate_average_words_per_sentence(text):
     sentences = text.split('.')
@@ -105,19 +415,42 @@ def calculate_capitalization_proportion(text):
     capitalized_count = sum(1 for c in text if c.isupper())
     return capitalized_count / letter_count if letter_count > 0 else 0
 
+@timed("word_commonality")
 def get_word_commonality(text, scale_factor=100):
     words = [word.strip(string.punctuation).lower() for word in text.split() if word.isalpha()]
     if not words:
         return 0.01
-    word_frequencies = [word_frequency(word, 'en') for word in words if word_frequency(word, 'en') > 0]
+    word_frequencies = [frequency for frequency in map(cached_word_frequency, words) if frequency > 0]
     return (sum(word_frequencies) / len(word_frequencies) * scale_factor) if word_frequencies else 0.01
 
+@timed("text_statistics")
+def calculate_text_statistics(text):
+    """Letter count, punctuation proportion, capitalization proportion and entropy
+    from one count of the characters. Gives the same values as the separate functions."""
+    total_characters = len(text)
+    if not total_characters:
+        return 0, 0, 0, 0
+    counts = Counter(text)
+    letter_count = punctuation_count = capitalized_count = 0
+    for c, count in counts.items():
+        if c.isalpha():
+            letter_count += count
+        if c.isupper():
+            capitalized_count += count
+        if c in PUNCTUATION:
+            punctuation_count += count
+    probabilities = [counts[c] / total_characters for c in sorted(counts)]
+    entropy = -sum(p * log2(p) for p in probabilities if p > 0)
+    capitalization_proportion = capitalized_count / letter_count if letter_count > 0 else 0
+    return letter_count, punctuation_count / total_characters, capitalization_proportion, entropy
+
 def calculate_entropy(text):
     if not text:
         return 0
-    probabilities = [text.count(c) / len(text) for c in set(text)]
+    probabilities = [text.count(c) / len(text) for c in sorted(set(text))]
     return -sum(p * log2(p) for p in probabilities if p > 0)
 
+@timed("drop_cap")
 def process_drop_cap(page_data):
     font_sizes = [block['font_size'] for block in page_data if 'font_size' in block]
     if not font_sizes:
@@ -140,5 +473,14 @@ def process_drop_cap(page_data):
 if __name__ == "__main__":
     input_file = input("File (without ending): ")
     input_file = input_file + ".pdf"
-    extract_geometric_features(input_file, "extracted_data.json")
+    workers = int(os.environ.get("EXTRACT_WORKERS", "1"))
+    pretty = os.environ.get("EXTRACT_FORMAT") == "json"
+    resume = os.environ.get("EXTRACT_RESUME") == "1"
+    incremental = os.environ.get("EXTRACT_INCREMENTAL") == "1"
+    output_file = "extracted_data.json" if pretty else "extracted_data.jsonl"
+    if os.environ.get("EXTRACT_CACHE") == "0":
+        extract_geometric_features(input_file, output_file, workers, pretty, resume, incremental=incremental)
+    else:
+        with FeatureCache() as cache:
+            extract_geometric_features(input_file, output_file, workers, pretty, resume, cache, incremental=incremental)
 
@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+
+DEFAULT_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "manual-classifier"))
+DEFAULT_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+COMMIT_EVERY = 64
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FeatureCache:
+    """Page features on disk, keyed by PDF content hash, page index and feature version.
+    Entries are evicted least recently used first once the cache exceeds max_bytes."""
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.pending = 0
+        self.db = sqlite3.connect(os.path.join(cache_dir, "features.sqlite"))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+            doc_hash TEXT, page INTEGER, version INTEGER, data BLOB, size INTEGER, last_used REAL,
+            PRIMARY KEY (doc_hash, page, version))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+
+    def cached_pages(self, doc_hash, version):
+        rows = self.db.execute("SELECT page FROM pages WHERE doc_hash = ? AND version = ?", (doc_hash, version))
+        return {page for page, in rows}
+
+    def get(self, doc_hash, version, page):
+        row = self.db.execute("SELECT data FROM pages WHERE doc_hash = ? AND page = ? AND version = ?", (doc_hash, page, version)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE pages SET last_used = ? WHERE doc_hash = ? AND page = ? AND version = ?", (time.time(), doc_hash, page, version))
+        self._written()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, doc_hash, version, page, page_data):
+        data = zlib.compress(json.dumps(page_data, ensure_ascii=False).encode("utf-8"))
+        self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", (doc_hash, page, version, data, len(data), time.time()))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending = 0
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM pages").fetchone()
+
+    def evict(self):
+        total, _ = self.size()
+        if total <= self.max_bytes:
+            return 0
+        evicted = []
+        for doc_hash, page, version, size in self.db.execute("SELECT doc_hash, page, version, size FROM pages ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((doc_hash, page, version))
+            total -= size
+        self.db.executemany("DELETE FROM pages WHERE doc_hash = ? AND page = ? AND version = ?", evicted)
+        self.db.commit()
+        return len(evicted)
+
+    def clear(self):
+        self.db.execute("DELETE FROM pages")
+        self.db.commit()
+        self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.commit()
+        self.evict()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "info"
+    with FeatureCache() as cache:
+        if command == "clear":
+            cache.clear()
+            print(f"Cleared feature cache in {DEFAULT_CACHE_DIR}")
+        elif command == "info":
+            total, count = cache.size()
+            print(f"{count} pages, {total / 1024 / 1024:.1f} of {cache.max_bytes / 1024 / 1024:.0f} MB in {DEFAULT_CACHE_DIR}")
+        else:
+            print(f"Unknown command '{command}'. Use 'info' or 'clear'.")
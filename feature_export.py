@@ -0,0 +1,68 @@
+import os
+import sys
+import glob
+import json
+import numpy as np
+from block_table import BlockTable
+from extract_pdf_data import FEATURE_COLUMNS
+
+NUMERIC_FEATURES = [name for name, dtype in FEATURE_COLUMNS if dtype is not str and name != "page"]
+
+def export_features(blocks, output_prefix):
+    """Write a BlockTable of extracted features as memory-mappable files:
+    <prefix>.features.npy  float32 matrix, one row per block, columns in NUMERIC_FEATURES order
+    <prefix>.pages.npy     int32 page number of each row
+    <prefix>.text.jsonl    one JSON string per row
+    <prefix>.columns.json  the column names of the matrix
+    Missing values (a block without a font size) are stored as NaN."""
+    if not len(blocks):
+        np.save(output_prefix + ".features.npy", np.empty((0, len(NUMERIC_FEATURES)), dtype=np.float32))
+    else:
+        write_feature_matrix(blocks, output_prefix + ".features.npy")
+    np.save(output_prefix + ".pages.npy", blocks.column("page").astype(np.int32))
+    with open(output_prefix + ".text.jsonl", "w", encoding="utf-8") as f:
+        for text in blocks.column("text"):
+            f.write(json.dumps(text, ensure_ascii=False) + "\n")
+    with open(output_prefix + ".columns.json", "w", encoding="utf-8") as f:
+        json.dump(NUMERIC_FEATURES, f)
+
+def write_feature_matrix(blocks, path):
+    features = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(len(blocks), len(NUMERIC_FEATURES)))
+    for column_index, name in enumerate(NUMERIC_FEATURES):
+        features[:, column_index] = blocks.column(name)
+    features.flush()
+
+def export_jsonl(jsonl_path, output_prefix=None):
+    """Convert the JSON lines written by extract_geometric_features to the binary layout."""
+    if output_prefix is None:
+        output_prefix = os.path.splitext(jsonl_path)[0]
+    blocks = BlockTable(FEATURE_COLUMNS)
+    with open(jsonl_path, encoding="utf-8") as f:
+        blocks.extend(json.loads(line) for line in f)
+    export_features(blocks, output_prefix)
+    return output_prefix
+
+def load_features(output_prefix, mmap_mode="r"):
+    """Return the feature matrix and page numbers of one document without parsing any text."""
+    features = np.load(output_prefix + ".features.npy", mmap_mode=mmap_mode)
+    pages = np.load(output_prefix + ".pages.npy", mmap_mode=mmap_mode)
+    return features, pages
+
+def load_texts(output_prefix):
+    with open(output_prefix + ".text.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def load_corpus(directory, mmap_mode="r"):
+    """Memory-map every exported document in a directory, keyed by its prefix name."""
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.features.npy"))):
+        output_prefix = path[:-len(".features.npy")]
+        corpus[os.path.basename(output_prefix)] = load_features(output_prefix, mmap_mode)
+    return corpus
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python feature_export.py <extracted .jsonl files>")
+        sys.exit(1)
+    for jsonl_path in sys.argv[1:]:
+        print(f"Exported {jsonl_path} to {export_jsonl(jsonl_path)}.features.npy")
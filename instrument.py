@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import atexit
+import cProfile
+import multiprocessing
+from collections import defaultdict
+from contextlib import nullcontext
+from functools import wraps
+
+PROFILE_ENV = "CLASSIFIER_PROFILE" #"1" for stage timers, "cprofile" or "cprofile:<path>" to also run cProfile
+enabled = False
+totals = defaultdict(float)
+calls = defaultdict(int)
+counters = defaultdict(int)
+_profiler = None
+_null_stage = nullcontext()
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        totals[self.name] += time.perf_counter() - self.start
+        calls[self.name] += 1
+
+def stage(name):
+    """Time a block of code under name. Returns a shared no-op context when disabled."""
+    return _Stage(name) if enabled else _null_stage
+
+def timed(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, amount=1):
+    if enabled:
+        counters[name] += amount
+
+def enable(cprofile_path=None, report=True):
+    """Start collecting. report=False collects without printing a summary at exit,
+    for worker processes that send their stages back with snapshot() and since()."""
+    global enabled, _profiler
+    if enabled:
+        return
+    enabled = True
+    if cprofile_path:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if report:
+        atexit.register(dump, cprofile_path=cprofile_path)
+
+def snapshot():
+    return dict(totals), dict(calls), dict(counters)
+
+def since(before):
+    """What was collected after snapshot() returned before, in the form merge() takes."""
+    return tuple({name: value - previous.get(name, 0) for name, value in current.items() if value != previous.get(name, 0)}
+                 for current, previous in zip(snapshot(), before))
+
+def merge(collected):
+    """Add stages collected in another process, as returned by since(), to this one."""
+    for target, values in zip((totals, calls, counters), collected):
+        for name, value in values.items():
+            target[name] += value
+
+def summary():
+    lines = [f"{'stage':<28} {'calls':>9} {'total s':>10} {'mean ms':>10}"]
+    for name in sorted(totals, key=totals.get, reverse=True):
+        lines.append(f"{name:<28} {calls[name]:>9} {totals[name]:>10.3f} {totals[name] / calls[name] * 1000:>10.3f}")
+    for name in sorted(counters):
+        lines.append(f"{name:<28} {counters[name]:>9}")
+    return "\n".join(lines)
+
+def dump(file=None, cprofile_path=None):
+    print(summary(), file=file or sys.stderr)
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(cprofile_path)
+        print(f"cProfile output written to {cprofile_path}", file=file or sys.stderr)
+
+_setting = os.environ.get(PROFILE_ENV, "")
+if multiprocessing.parent_process() is not None:
+    #Worker processes send their stages to the main process instead of printing them
+    if _setting not in ("", "0"):
+        enable(report=False)
+elif _setting.startswith("cprofile"):
+    enable(_setting.partition(":")[2] or "profile.out")
+elif _setting not in ("", "0"):
+    enable()
@@ -0,0 +1,261 @@
+import os
+import io
+import json
+import asyncio
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+import fitz
+from utils import LazyBlockList, LabelWriter, SessionJournal, render_page
+
+LABELS = ("Header", "Body", "Footer", "Quote", "Exclude")
+DEFAULT_TILE_SIZE = (1400, 800)
+MAX_TILE_SIDE = 4096
+MAX_BODY_BYTES = 1 << 20
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class DocumentSession:
+    """One PDF served to any number of annotators. Labels from all of them go to the
+    document's journal under its lock, and the outputs are compacted from the journal."""
+    def __init__(self, name, pdf_path, output_dir):
+        self.name = name
+        self.doc = fitz.open(pdf_path)
+        self.blocks = LazyBlockList(self.doc)
+        self.journal = SessionJournal(pdf_path)
+        self.labels, _, _ = self.journal.replay()
+        self.output_file = os.path.join(output_dir, f"{name}.output.json")
+        self.ground_truth_file = os.path.join(output_dir, f"{name}.ground_truth.json")
+        self.lock = asyncio.Lock()
+
+    def write_output(self):
+        """Write every labelled page in reading order, leaving out unmarked and excluded blocks.
+        A document without labels is left alone and False returned. Only the pages up to the
+        last labelled block are extracted, since no later page has anything to write."""
+        if not self.labels:
+            return False
+        self.blocks.ensure_block(max(self.labels))
+        with LabelWriter(self.output_file, self.ground_truth_file) as writer:
+            for page_blocks in self.blocks.page_blocks:
+                for idx in sorted(page_blocks, key=lambda idx: (self.blocks[idx]['y0'], self.blocks[idx]['x0'])):
+                    label = self.labels.get(idx) or 'Exclude'
+                    if label != 'Exclude':
+                        block = self.blocks[idx]
+                        writer.write(block['text'], label.lower(), block['page'])
+        return True
+
+class LabelServer:
+    """Serves page images and block lists of a directory of PDFs and accepts labels over HTTP.
+    All MuPDF work runs on one dedicated thread, since MuPDF is not thread-safe, and each
+    rendered page is kept in a shared cache. Concurrent requests for a page that is still
+    rendering wait for that render instead of starting another."""
+    def __init__(self, pdf_dir, output_dir, cache_pages=256, prefetch=2):
+        self.output_dir = output_dir
+        self.prefetch = prefetch
+        self.documents = {}
+        for file_name in sorted(os.listdir(pdf_dir)):
+            if file_name.lower().endswith(".pdf"):
+                name = os.path.splitext(file_name)[0]
+                self.documents[name] = DocumentSession(name, os.path.join(pdf_dir, file_name), output_dir)
+        self.mupdf_executor = ThreadPoolExecutor(max_workers=1)
+        self.tiles = OrderedDict()
+        self.rendering = {}
+        self.prefetching = set()
+        self.cache_pages = cache_pages
+
+    async def mupdf(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.mupdf_executor, function, *args)
+
+    def document(self, name):
+        if name not in self.documents:
+            raise HTTPError(404, f"unknown document '{name}'")
+        return self.documents[name]
+
+    async def page_tile(self, document, page_num, size):
+        key = (document.name, page_num, size)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        if key not in self.rendering:
+            self.rendering[key] = asyncio.ensure_future(self.mupdf(render_tile, document.doc, page_num, size))
+        try:
+            tile = await asyncio.shield(self.rendering[key])
+        finally:
+            self.rendering.pop(key, None)
+        self.tiles[key] = tile
+        while len(self.tiles) > self.cache_pages:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def prefetch_tiles(self, document, page_num, size):
+        for next_page in range(page_num + 1, min(page_num + 1 + self.prefetch, document.doc.page_count)):
+            if (document.name, next_page, size) not in self.tiles:
+                task = asyncio.ensure_future(self.page_tile(document, next_page, size))
+                self.prefetching.add(task)
+                task.add_done_callback(self.prefetching.discard)
+
+    async def handle(self, method, path, query, body):
+        parts = [unquote(part) for part in path.strip("/").split("/") if part]
+        if parts == ["docs"] and method == "GET":
+            return json_response([{"name": name, "pages": document.doc.page_count} for name, document in self.documents.items()])
+        if len(parts) < 2 or parts[0] != "docs":
+            raise HTTPError(404, "not found")
+        document = self.document(parts[1])
+        if len(parts) == 5 and parts[2] == "pages" and method == "GET":
+            page_num = parse_page(parts[3], document)
+            if parts[4] == "blocks":
+                return json_response(await self.page_blocks(document, page_num))
+            if parts[4] == "image":
+                size = parse_size(query)
+                png, scale = await self.page_tile(document, page_num, size)
+                self.prefetch_tiles(document, page_num, size)
+                return 200, "image/png", png, {"X-Scale": f"{scale:.6f}"}
+        if len(parts) == 3 and parts[2] == "labels" and method == "POST":
+            return json_response(await self.submit_labels(document, parse_json(body)))
+        if len(parts) == 3 and parts[2] == "export" and method == "POST":
+            async with document.lock:
+                if not await self.mupdf(document.write_output):
+                    raise HTTPError(400, f"'{document.name}' has no labels to export")
+            return json_response({"output": document.output_file, "ground_truth": document.ground_truth_file})
+        raise HTTPError(405 if len(parts) in (3, 5) else 404, "unsupported request")
+
+    async def page_blocks(self, document, page_num):
+        await self.mupdf(document.blocks.ensure_page, page_num)
+        blocks = []
+        for idx in document.blocks.page_blocks[page_num]:
+            block = document.blocks[idx]
+            blocks.append({"id": idx, "x0": block['x0'], "y0": block['y0'], "x1": block['x1'], "y1": block['y1'],
+                           "text": block['text'], "label": document.labels.get(idx)})
+        return {"document": document.name, "page": page_num, "blocks": blocks}
+
+    async def submit_labels(self, document, request):
+        """Apply {"session": ..., "labels": [{"id": block id, "label": ...}]} to the document."""
+        if not isinstance(request, dict):
+            raise HTTPError(400, "the request body must be a JSON object")
+        session = str(request.get("session", "anonymous"))
+        labels = request.get("labels")
+        if not isinstance(labels, list):
+            raise HTTPError(400, "'labels' must be a list")
+        events = []
+        for entry in labels:
+            idx, label = entry.get("id") if isinstance(entry, dict) else None, entry.get("label") if isinstance(entry, dict) else None
+            if type(idx) is not int or idx < 0 or label not in LABELS:
+                raise HTTPError(400, f"invalid label entry {entry!r}; labels are {', '.join(LABELS)}")
+            if not await self.mupdf(document.blocks.ensure_block, idx):
+                raise HTTPError(400, f"unknown block id {idx}")
+            events.append(("label", idx, label, session))
+        async with document.lock:
+            document.journal.append_many(events)
+            for _, idx, label, _ in events:
+                document.labels[idx] = label
+        return {"applied": len(events)}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            status, content_type, body, headers = await self.respond(reader)
+        except HTTPError as e:
+            status, content_type, body, headers = error_response(e.status, str(e))
+        except Exception as e:
+            status, content_type, body, headers = error_response(500, str(e))
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{key}: {value}" for key, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, target, _ = request_line
+        content_length = 0
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            if key.strip().lower() == "content-length":
+                try:
+                    content_length = int(value.strip())
+                except ValueError:
+                    raise HTTPError(400, "invalid Content-Length")
+                if content_length < 0:
+                    raise HTTPError(400, "invalid Content-Length")
+        if content_length > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(content_length) if content_length else b""
+        url = urlsplit(target)
+        return await self.handle(method, url.path, parse_qs(url.query), body)
+
+    def close(self):
+        # Let a render in progress finish and drop queued ones first, so MuPDF is never used from two threads
+        self.mupdf_executor.shutdown(wait=True, cancel_futures=True)
+        for document in self.documents.values():
+            document.write_output()
+            document.journal.close()
+            document.doc.close()
+
+def render_tile(doc, page_num, size):
+    img, scale = render_page(doc.load_page(page_num), *size)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue(), scale
+
+def parse_page(value, document):
+    if not value.isdigit() or int(value) >= document.doc.page_count:
+        raise HTTPError(404, f"no page {value} in '{document.name}'")
+    return int(value)
+
+def parse_size(query):
+    try:
+        size = tuple(int(query.get(key, [default])[0]) for key, default in zip(("width", "height"), DEFAULT_TILE_SIZE))
+    except ValueError:
+        raise HTTPError(400, "width and height must be integers")
+    if not all(0 < value <= MAX_TILE_SIDE for value in size):
+        raise HTTPError(400, f"width and height must be between 1 and {MAX_TILE_SIDE}")
+    return size
+
+def parse_json(body):
+    try:
+        return json.loads(body or b"{}")
+    except ValueError as e:
+        raise HTTPError(400, f"invalid JSON: {e}")
+
+def json_response(data, status=200):
+    return status, "application/json", json.dumps(data, ensure_ascii=False).encode("utf-8"), {}
+
+def error_response(status, message):
+    return json_response({"error": message}, status)
+
+async def serve(pdf_dir, output_dir, host, port):
+    label_server = LabelServer(pdf_dir, output_dir)
+    server = await asyncio.start_server(label_server.serve_connection, host, port)
+    print(f"Serving {len(label_server.documents)} documents on http://{host}:{port}/docs")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        label_server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless labelling server with a local HTTP API.")
+    parser.add_argument("pdf_dir", help="directory of PDFs to serve")
+    parser.add_argument("-o", "--output-dir", default=".", help="where <name>.output.json and <name>.ground_truth.json are written")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        asyncio.run(serve(args.pdf_dir, args.output_dir, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
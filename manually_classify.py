@@ -3,8 +3,11 @@ import sys
 import fitz
 import tkinter as tk
 from tkinter import messagebox
-from PIL import Image, ImageTk, ImageDraw
-from utils import extract_blocks, drop_to_file
+from PIL import ImageTk
+from instrument import stage
+from utils import LazyBlockList, LabelWriter, PageRenderCache, SessionJournal
+
+BLOCK_MARGIN = 20
 
 class ManualClassifierGUI:
     def __init__(self, pdf_path, output_file="output.txt"):
@@ -12,12 +15,22 @@ class ManualClassifierGUI:
         self.output_file = output_file
         self.doc = fitz.open(self.pdf_path)
         self.total_pages = self.doc.page_count
-        self.all_blocks = extract_blocks(self.pdf_path)
-        self.total_blocks = len(self.all_blocks)
-        self.current_index = 0
-        self.classifications = []
-        self.undo_stack = []
-        self.pending_classification = None
+        self.render_cache = PageRenderCache(self.doc, 1400, 800)
+        self.all_blocks = LazyBlockList(self.doc, self.render_cache.render_lock)
+        self.journal = SessionJournal(self.pdf_path)
+        labels, self.undo_stack, _ = self.journal.replay()
+        if labels:
+            self.all_blocks.ensure_block(max(labels))
+        self.labels = {idx: label for idx, label in labels.items() if idx < len(self.all_blocks)}
+        self.current_index = max(self.labels) + 1 if self.labels else 0
+        if not self.all_blocks.ensure_block(self.current_index):
+            # Every block was labelled in an earlier session: rewrite the output without opening a window
+            self.write_output()
+            self.close_document()
+            print("All blocks were already classified.")
+            return
+        self.displayed_page = None
+        self.zoom_to_block = False
         self.root = tk.Tk()
         self.root.title("Manual PDF Block Classifier")
         self.canvas = tk.Canvas(self.root, bg="white")
@@ -42,94 +55,112 @@ class ManualClassifierGUI:
         self.root.bind('f', lambda event: self.classify(2))
         self.root.bind('q', lambda event: self.classify(3))
         self.root.bind('e', lambda event: self.classify(4))
+        self.root.bind('z', lambda event: self.toggle_zoom())
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(1, self.extract_in_background)
         self.root.mainloop()
 
     def load_current_block(self):
-        if self.current_index < 0 or self.current_index >= self.total_blocks:
+        if self.current_index < 0 or not self.all_blocks.ensure_block(self.current_index):
+            self.write_output()
             self.status_var.set("All blocks have been classified.")
             messagebox.showinfo("Completion", "All blocks have been classified.")
-            self.root.quit()
+            self.close_document()
+            self.root.destroy()
             return
         block = self.all_blocks[self.current_index]
         page_number = block['page']
-        page = self.doc.load_page(page_number)
-        zoom = 2
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        mode = "RGB" if pix.alpha == 0 else "RGBA"
-        img = Image.frombytes(mode, [pix.width, pix.height], pix.samples)
-        x0, y0, x1, y1 = block['x0'], block['y0'], block['x1'], block['y1']
-        x0_zoomed, y0_zoomed = x0 * zoom, y0 * zoom
-        x1_zoomed, y1_zoomed = x1 * zoom, y1 * zoom
-        draw = ImageDraw.Draw(img)
-        draw.rectangle([x0_zoomed, y0_zoomed, x1_zoomed, y1_zoomed], outline="black", width=4)
-        max_width, max_height = 1400, 800
-        img_width, img_height = img.size
-        scale = min(max_width / img_width, max_height / img_height, 1)
-        new_size = (int(img_width * scale), int(img_height * scale))
-        img = img.resize(new_size, Image.Resampling.LANCZOS)
-        self.photo = ImageTk.PhotoImage(img)
-        self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
-        screen_width = self.root.winfo_screenwidth()
-        screen_height = self.root.winfo_screenheight()
-        window_width = new_size[0]
-        window_height = new_size[1] + 100
-        x = (screen_width // 2) - (window_width // 2)
-        y = (screen_height // 2) - (window_height // 2)
-        self.root.geometry(f"{window_width}x{window_height}+{x}+{y}")
-        self.status_var.set(f"Block {self.current_index + 1} of {self.total_blocks} (Page {page_number + 1})")
+        origin_x = origin_y = 0
+        if self.zoom_to_block:
+            origin_x, origin_y = max(block['x0'] - BLOCK_MARGIN, 0), max(block['y0'] - BLOCK_MARGIN, 0)
+            clip = fitz.Rect(origin_x, origin_y, block['x1'] + BLOCK_MARGIN, block['y1'] + BLOCK_MARGIN)
+            img, scale = self.render_cache.render_clip(page_number, clip)
+        else:
+            img, scale = self.render_cache.get(page_number)
+        if self.zoom_to_block or page_number != self.displayed_page:
+            with stage("photo_image"):
+                self.photo = ImageTk.PhotoImage(img)
+            self.canvas.delete("all")
+            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+            self.displayed_page = None if self.zoom_to_block else page_number
+            screen_width = self.root.winfo_screenwidth()
+            screen_height = self.root.winfo_screenheight()
+            window_width = img.width
+            window_height = img.height + 100
+            x = (screen_width // 2) - (window_width // 2)
+            y = (screen_height // 2) - (window_height // 2)
+            self.root.geometry(f"{window_width}x{window_height}+{x}+{y}")
+        self.canvas.delete("outline")
+        x0, y0 = (block['x0'] - origin_x) * scale, (block['y0'] - origin_y) * scale
+        x1, y1 = (block['x1'] - origin_x) * scale, (block['y1'] - origin_y) * scale
+        self.canvas.create_rectangle(x0, y0, x1, y1, outline="black", width=2, tags="outline")
+        self.render_cache.prefetch(page_number + 1, page_number + 2)
+        self.update_status()
+
+    def update_status(self):
+        total_blocks = len(self.all_blocks) if self.all_blocks.complete else "?"
+        page_number = self.all_blocks[self.current_index]['page']
+        self.status_var.set(f"Block {self.current_index + 1} of {total_blocks} (Page {page_number + 1})")
+
+    def extract_in_background(self):
+        """Extract the remaining pages one per event loop turn, so the window stays responsive."""
+        if self.all_blocks.extract_next_page():
+            self.root.after(1, self.extract_in_background)
+        elif self.current_index < len(self.all_blocks):
+            self.update_status()
+
+    def toggle_zoom(self):
+        self.zoom_to_block = not self.zoom_to_block
+        self.displayed_page = None
+        self.load_current_block()
 
     def classify(self, label_idx):
+        if not self.all_blocks.ensure_block(self.current_index):
+            return
         label = self.button_texts[label_idx]
         #if label == "exclude":
         #    self.current_index += 1
         #    self.load_current_block()
         #    return
-        block = self.all_blocks[self.current_index]
-        block_text = block['raw_block'][4]
-        block_page_number = block['page']
-        if self.pending_classification is not None:
-            drop_to_file(self.pending_classification[0], self.pending_classification[1].lower(), self.pending_classification[2])
-            self.undo_stack.append(self.pending_classification)
-        self.pending_classification = (block_text, label, block_page_number)
+        idx = self.current_index
+        self.journal.append("label", idx, label)
+        self.undo_stack.append((idx, self.labels.get(idx)))
+        self.labels[idx] = label
         self.current_index += 1
         self.load_current_block()
 
     def undo(self):
-        if self.pending_classification is not None:
-            self.pending_classification = None
-            self.current_index -= 1
-            self.load_current_block()
-            return
         if not self.undo_stack:
             messagebox.showwarning("Undo", "No actions to undo.")
             return
-        last_classification = self.undo_stack.pop()
-        self.current_index -= 1
-        self.remove_last_line(self.output_file)
+        self.journal.append("undo")
+        idx, previous = self.undo_stack.pop()
+        if previous is None:
+            self.labels.pop(idx, None)
+        else:
+            self.labels[idx] = previous
+        self.current_index = idx
         self.load_current_block()
-        def remove_last_line(self, filename):
-            try:
-                with open(filename, "rb+") as f:
-                    f.seek(-1, os.SEEK_END)
-                    while f.read(1) != b'\n' and f.tell() > 1:
-                        f.seek(-2, os.SEEK_CUR)
-                    if f.tell() > 1:
-                        f.seek(-1, os.SEEK_CUR)
-                    f.truncate()
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to undo last action: {e}")
+
+    def write_output(self):
+        """Compact the journalled labels into the output files, in block order."""
+        with LabelWriter(self.output_file) as writer:
+            for idx in sorted(self.labels):
+                block = self.all_blocks[idx]
+                writer.write(block['text'], self.labels[idx].lower(), block['page'])
 
     def on_close(self):
-        if self.pending_classification is not None:
-            drop_to_file(self.pending_classification[0], self.pending_classification[1], self.pending_classification[2])
+        self.write_output()
         #if messagebox.askokcancel("Quit", "Do you want to quit?"):
-        self.doc.close()
+        self.close_document()
         self.root.destroy()
         sys.exit()
 
+    def close_document(self):
+        self.journal.close()
+        self.render_cache.close()
+        self.doc.close()
+
 def main():
     file_name = input("File name (without ending): ")
     pdf_path = f"{file_name}.pdf"
@@ -137,7 +168,6 @@ def main():
     if not os.path.exists(pdf_path):
         print(f"PDF file '{pdf_path}' not found.")
         return
-    open(output_file, "w", encoding='utf-8').close()
     gui = ManualClassifierGUI(pdf_path, output_file)
     print("Classification completed.")
 
@@ -0,0 +1,46 @@
+import json
+import fitz
+import pytest
+import extract_pdf_data
+
+EDGE_CASE_TEXTS = [
+    "",
+    " ",
+    "1",
+    ".",
+    "CHAPTER ONE",
+    "Ünïcödé Straße, naïve café — “quoted” text…",
+    "ǅ ǈ ǋ titlecase digraphs, ΣΑΣ and ﬁ ligatures",
+    "The quick brown fox jumps over the lazy dog. " * 40,
+    "Footnote 12: see p. 345-346 (ibid.); cf. [7], {8} & <9>!",
+    "\tTabs\nand\nnewlines\r\n" * 5,
+    "​ zero width and no-break spaces ",
+]
+
+def separate_text_statistics(text):
+    return (extract_pdf_data.calculate_letter_count(text),
+            extract_pdf_data.calculate_punctuation_proportion(text),
+            extract_pdf_data.calculate_capitalization_proportion(text),
+            extract_pdf_data.calculate_entropy(text))
+
+@pytest.mark.parametrize("text", EDGE_CASE_TEXTS)
+def test_text_statistics_match_separate_functions(text):
+    assert extract_pdf_data.calculate_text_statistics(text) == separate_text_statistics(text)
+
+def test_pretty_output_matches_jsonl(tmp_path):
+    pdf_path = str(tmp_path / "sample.pdf")
+    doc = fitz.open()
+    for page_num in range(2):
+        page = doc.new_page()
+        page.insert_text((72, 72), "Chapter One", fontsize=18)
+        page.insert_text((72, 120), "The quick brown fox jumps over the lazy dog.\nIt was a dark and stormy night.", fontsize=10)
+        page.insert_text((300, 800), str(12 + page_num), fontsize=10)
+    doc.save(pdf_path)
+    doc.close()
+    jsonl_path, json_path = str(tmp_path / "out.jsonl"), str(tmp_path / "out.json")
+    extract_pdf_data.extract_geometric_features(pdf_path, jsonl_path, verbose=False)
+    extract_pdf_data.extract_geometric_features(pdf_path, json_path, pretty=True, verbose=False)
+    with open(jsonl_path, encoding="utf-8") as f:
+        expected = json.dumps([json.loads(line) for line in f], indent=2, ensure_ascii=False)
+    with open(json_path, encoding="utf-8") as f:
+        assert f.read() == expected
@@ -0,0 +1,29 @@
+import pytest
+from utils import LayoutSignatureIndex
+
+DIGIT_WIDTH = 5.56 #Width of a digit at 10 pt
+
+def page_number_blocks(pages, alignment):
+    """A running header and a page number at the foot of every page, as get_text("blocks") would give them."""
+    blocks = []
+    for page_num in range(pages):
+        blocks.append({'page': page_num, 'x0': 72.0, 'y0': 40.0, 'x1': 300.0, 'y1': 52.0, 'text': "A Running Header\n"})
+        text = str(page_num + 1)
+        width = DIGIT_WIDTH * len(text)
+        x0 = {"left": 72.0, "right": 540.0 - width, "centre": 306.0 - width / 2}[alignment]
+        blocks.append({'page': page_num, 'x0': x0, 'y0': 750.0, 'x1': x0 + width, 'y1': 762.0, 'text': text + "\n"})
+    return blocks
+
+@pytest.mark.parametrize("alignment", ["left", "right", "centre"])
+def test_page_numbers_match_across_digit_counts(alignment):
+    blocks = page_number_blocks(120, alignment)
+    index = LayoutSignatureIndex(blocks)
+    for page_num in (0, 9, 99):
+        assert index.matches(2 * page_num + 1) == [idx for idx in range(1, len(blocks), 2) if idx != 2 * page_num + 1]
+    assert index.matches(0) == list(range(2, len(blocks), 2))
+
+def test_numbers_elsewhere_on_the_page_do_not_match():
+    blocks = page_number_blocks(3, "left")
+    blocks.append({'page': 1, 'x0': 400.0, 'y0': 750.0, 'x1': 405.56, 'y1': 762.0, 'text': "7\n"})
+    blocks.append({'page': 2, 'x0': 72.0, 'y0': 400.0, 'x1': 77.56, 'y1': 412.0, 'text': "8\n"})
+    assert LayoutSignatureIndex(blocks).matches(1) == [3, 5]
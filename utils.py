@@ -1,25 +1,143 @@
 import os
+import re
+import json
+import queue
+import threading
+from collections import OrderedDict, defaultdict
 import fitz
+from PIL import Image
+from block_table import BlockTable
+from feature_cache import file_hash
+from instrument import stage, timed, count
+debug = False
+LABEL_MAPPING = {"header": "h1", "body": "p", "footer": "footer", "quote": "blockquote", "exclude": "exclude"}
 
 def extract_blocks(pdf_path):
-    blocks = []
+    blocks = BlockTable()
     doc = fitz.open(pdf_path)
-    for page_num, page in enumerate(doc):
-        for block in page.get_text("blocks"):
-            blocks.append({
-                'page': page_num,
-                'x0': block[0],
-                'y0': block[1],
-                'x1': block[2],
-                'y1': block[3],
-                'raw_block': block
-            })
+    for page_num in range(doc.page_count):
+        blocks.extend(extract_page_blocks(doc, page_num))
     doc.close()
     return blocks
 
-def drop_to_file(block_text, block_type, block_page_number):
+@timed("get_text_blocks")
+def extract_page_blocks(doc, page_num):
+    return [{
+        'page': page_num,
+        'x0': block[0],
+        'y0': block[1],
+        'x1': block[2],
+        'y1': block[3],
+        'text': block[4]
+    } for block in doc.load_page(page_num).get_text("blocks")]
+
+class LazyBlockList:
+    """The blocks of an already open document, extracted one page at a time on demand.
+    Blocks get the same document-order indices as extract_blocks would give them.
+    page_blocks lists the block indices of each page extracted so far."""
+    def __init__(self, doc, lock=None):
+        self.doc = doc
+        self.lock = lock or threading.Lock()
+        self.blocks = BlockTable()
+        self.page_blocks = []
+
+    @property
+    def complete(self):
+        return len(self.page_blocks) >= self.doc.page_count
+
+    def extract_next_page(self):
+        if self.complete:
+            return False
+        page_num = len(self.page_blocks)
+        with self.lock:
+            page_blocks = extract_page_blocks(self.doc, page_num)
+        self.page_blocks.append(range(len(self.blocks), len(self.blocks) + len(page_blocks)))
+        self.blocks.extend(page_blocks)
+        return True
+
+    def ensure_page(self, page_num):
+        while len(self.page_blocks) <= page_num and self.extract_next_page():
+            pass
+        return page_num < len(self.page_blocks)
+
+    def ensure_block(self, idx):
+        while len(self.blocks) <= idx and self.extract_next_page():
+            pass
+        return idx < len(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        return self.blocks[idx]
+
+class BlockGrid:
+    """Uniform grid over the blocks of one page for hit-testing points.
+    Each cell lists the blocks overlapping it in document order."""
+    def __init__(self, blocks, block_indices, cell_size=50):
+        self.blocks = blocks
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        for idx in block_indices:
+            block = blocks[idx]
+            for cx in range(int(block['x0'] // cell_size), int(block['x1'] // cell_size) + 1):
+                for cy in range(int(block['y0'] // cell_size), int(block['y1'] // cell_size) + 1):
+                    self.cells[(cx, cy)].append(idx)
+
+    def find(self, x, y):
+        for idx in self.cells.get((int(x // self.cell_size), int(y // self.cell_size)), ()):
+            block = self.blocks[idx]
+            if block['x0'] <= x <= block['x1'] and block['y0'] <= y <= block['y1']:
+                return idx
+        return None
+
+class LayoutSignatureIndex:
+    """Finds blocks that repeat across pages at nearly the same position with the same
+    text apart from numbers, such as running headers, footers and page numbers.
+    Blocks match when their top and bottom edges agree and their left edge, right edge or
+    centre does, so left-, right- and centre-aligned page numbers still match as they grow
+    from one digit to three. Blocks are bucketed by text signature and rounded top edge,
+    so a lookup only compares a handful of candidates. update() indexes blocks extracted since the last call."""
+    def __init__(self, blocks, tolerance=4.0):
+        self.blocks = blocks
+        self.tolerance = tolerance
+        self.buckets = defaultdict(list)
+        self.indexed = 0
+
+    @staticmethod
+    def text_signature(text):
+        return re.sub(r"\d+", "#", " ".join(text.lower().split()))
+
+    def update(self):
+        for idx in range(self.indexed, len(self.blocks)):
+            block = self.blocks[idx]
+            self.buckets[(self.text_signature(block['text']), round(block['y0'] / self.tolerance))].append(idx)
+        self.indexed = len(self.blocks)
+
+    def matches(self, idx):
+        self.update()
+        block = self.blocks[idx]
+        signature = self.text_signature(block['text'])
+        bucket = round(block['y0'] / self.tolerance)
+        anchors = self.horizontal_anchors(block)
+        found = []
+        for nearby in (bucket - 1, bucket, bucket + 1):
+            for other in self.buckets.get((signature, nearby), ()):
+                if other == idx:
+                    continue
+                other_block = self.blocks[other]
+                if abs(other_block['y0'] - block['y0']) > self.tolerance or abs(other_block['y1'] - block['y1']) > self.tolerance:
+                    continue
+                if any(abs(other_anchor - anchor) <= self.tolerance for other_anchor, anchor in zip(self.horizontal_anchors(other_block), anchors)):
+                    found.append(other)
+        return sorted(found)
+
+    @staticmethod
+    def horizontal_anchors(block):
+        return block['x0'], block['x1'], (block['x0'] + block['x1']) / 2
+
+def format_label_entries(block_text, block_type, block_page_number):
     if debug: print(type(block_text), type(block_type), type(block_page_number), sep='\n', end='\n')
-    label_mapping = {"header": "h1", "body": "p", "footer": "footer", "quote": "blockquote", "exclude": "exclude"}
     if block_type == "exclude":
         entry = {
             "label": block_type,
@@ -28,20 +146,185 @@ def drop_to_file(block_text, block_type, block_page_number):
         entry_unmapped = entry
     else:
         entry = {
-            "label": label_mapping.get(block_type, "unknown"),
+            "label": LABEL_MAPPING.get(block_type, "unknown"),
             "page": block_page_number + 1,
             "text": block_text}
         entry_unmapped = {
             "label": block_type,
             "page": block_page_number + 1,
             "text": block_text}
-    with open("output.json", "a", encoding='utf-8') as file:
-        file.write(json.dumps(entry, ensure_ascii=False) + "\n")
-    with open("ground_truth.json", "a", encoding='utf-8') as file:
-        file.write(json.dumps(entry_unmapped, ensure_ascii=False) + "\n")
     if debug: print(entry)
+    return json.dumps(entry, ensure_ascii=False) + "\n", json.dumps(entry_unmapped, ensure_ascii=False) + "\n"
+
+class LabelWriter:
+    """Writes labelled blocks to output.json and ground_truth.json, replacing what they held.
+    The session journal is the record of progress, so the outputs are always rewritten
+    from it in one pass rather than appended to while labelling."""
+    def __init__(self, output_file="output.json", ground_truth_file="ground_truth.json"):
+        self.files = [open(output_file, "w", encoding='utf-8'), open(ground_truth_file, "w", encoding='utf-8')]
+
+    @timed("label_write")
+    def write(self, block_text, block_type, block_page_number):
+        for file, line in zip(self.files, format_label_entries(block_text, block_type, block_page_number)):
+            file.write(line)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SessionJournal:
+    """Append-only log of the labelling events of one PDF, replayed on startup to resume.
+    Each line is a JSON array: ["label", block_index, label], ["undo"] or ["page", page_number].
+    label_server.py appends the submitting session as a fourth element of label events.
+    The first line, ["document", sha256 of the PDF], ties the journal to one version of the
+    file: if a different PDF is found at the same path, the old journal is moved to
+    <journal>.old and a new one is started, since its block indices would point at other blocks.
+    A line cut short by a crash is dropped when the journal is read."""
+    def __init__(self, pdf_path):
+        self.path = pdf_path + ".journal"
+        header = ["document", file_hash(pdf_path)]
+        self.events = []
+        valid_bytes = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self.events.append(json.loads(line))
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+        if self.events and self.events[0] == header:
+            self.events.pop(0)
+            self.file = open(self.path, "ab")
+            self.file.truncate(valid_bytes)
+            return
+        if self.events and self.events[0][0] == "document":
+            os.replace(self.path, self.path + ".old")
+            print(f"Warning: {pdf_path} has changed since its journal was written. The old journal was moved to {self.path}.old and labelling starts over.")
+            self.events = []
+        # A new journal, or one written before journals recorded their PDF: rewrite it with the header first
+        with open(self.path + ".tmp", "wb") as f:
+            f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in [header] + self.events).encode("utf-8"))
+        os.replace(self.path + ".tmp", self.path)
+        self.file = open(self.path, "ab")
+
+    def append(self, *event):
+        self.append_many([event])
+
+    @timed("journal_append")
+    def append_many(self, events):
+        lines = []
+        for event in events:
+            self.events.append(list(event))
+            lines.append(json.dumps(list(event), ensure_ascii=False) + "\n")
+        self.file.write("".join(lines).encode("utf-8"))
+        self.file.flush()
+
+    def replay(self):
+        """Return the current label of each block, the undo history and the last page reached."""
+        labels = {}
+        history = []
+        page = 0
+        for event in self.events:
+            if event[0] == "label":
+                idx, label = event[1], event[2]
+                history.append((idx, labels.get(idx)))
+                labels[idx] = label
+            elif event[0] == "undo" and history:
+                idx, previous = history.pop()
+                if previous is None:
+                    labels.pop(idx, None)
+                else:
+                    labels[idx] = previous
+            elif event[0] == "page":
+                page = event[1]
+        return labels, history, page
+
+    def close(self):
+        self.file.close()
 
 def delete_if_exists(del_file):
     if os.path.exists(del_file):
         os.remove(del_file)
 
+def render_page(page, max_width, max_height, clip=None, max_zoom=2):
+    """Rasterize a page, or only its clip rectangle, directly at the size that fits
+    max_width x max_height, enlarging by at most max_zoom. Returns (image, scale),
+    where scale maps PDF coordinates (relative to the clip origin) to image pixels."""
+    rect = fitz.Rect(clip) & page.rect if clip is not None else page.rect
+    scale = min(max_width / rect.width, max_height / rect.height, max_zoom)
+    with stage("get_pixmap"):
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=rect if clip is not None else None)
+    mode = "RGB" if pix.alpha == 0 else "RGBA"
+    with stage("pixmap_to_image"):
+        return Image.frombytes(mode, [pix.width, pix.height], pix.samples), scale
+
+class PageRenderCache:
+    """Bounded cache of rendered pages scaled to fit max_width x max_height.
+    get() returns (image, scale), where scale maps PDF coordinates to image pixels.
+    prefetch() queues pages for a background thread to render ahead of time.
+    MuPDF is not thread-safe, so all rendering on the document holds render_lock."""
+    def __init__(self, doc, max_width, max_height, max_pages=8):
+        self.doc = doc
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._prefetch_worker, daemon=True)
+        self.thread.start()
+
+    def get(self, page_number):
+        with self.lock:
+            if page_number in self.pages:
+                count("render_cache_hit")
+                self.pages.move_to_end(page_number)
+                return self.pages[page_number]
+        count("render_cache_miss")
+        return self._render(page_number)
+
+    def render_clip(self, page_number, clip):
+        """Render only the clip rectangle of a page, enlarged to fit the display. Not cached."""
+        with self.render_lock:
+            return render_page(self.doc.load_page(page_number), self.max_width, self.max_height, clip)
+
+    def prefetch(self, *page_numbers):
+        for page_number in page_numbers:
+            if 0 <= page_number < self.doc.page_count:
+                self.requests.put(page_number)
+
+    def close(self):
+        while not self.requests.empty():
+            self.requests.get_nowait()
+        self.requests.put(None)
+        self.thread.join()
+
+    def _prefetch_worker(self):
+        while True:
+            page_number = self.requests.get()
+            if page_number is None:
+                return
+            with self.lock:
+                if page_number in self.pages:
+                    continue
+            self._render(page_number)
+
+    def _render(self, page_number):
+        with self.render_lock:
+            entry = render_page(self.doc.load_page(page_number), self.max_width, self.max_height)
+        with self.lock:
+            self.pages[page_number] = entry
+            self.pages.move_to_end(page_number)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return entry